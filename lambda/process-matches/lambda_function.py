@@ -1,8 +1,21 @@
 import json
 import boto3
-import csv
-from io import StringIO
+import orjson
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import os
+import gzip
+import base64
+from match_stats import (
+    MAX_DOWNLOAD_WORKERS, STATS_FIELDS, build_stats_row, cache_match_object, iter_body_lines,
+    load_match_objects, match_cache, upload_csv
+)
+
+# Responses smaller than this aren't worth compressing
+MIN_GZIP_RESPONSE_BYTES = 1024
+
+# Created once per container so warm invocations reuse connections and credentials
+s3 = boto3.client('s3', config=Config(max_pool_connections=MAX_DOWNLOAD_WORKERS))
 
 def lambda_handler(event, context):
     """
@@ -23,81 +36,44 @@ def lambda_handler(event, context):
         # Get bucket name from environment
         bucket_name = os.environ.get('MATCH_DATA_BUCKET')
 
-        s3 = boto3.client('s3')
+        # Prefer the consolidated match log: one GET instead of one per match
+        consolidated_key = f"users/{puuid}/matches.ndjson"
 
-        # List all match files for this user
-        prefix = f"users/{puuid}/matches/"
-
-        print(f"🔍 Looking for matches at s3://{bucket_name}/{prefix}")
+        print(f"🔍 Looking for matches at s3://{bucket_name}/{consolidated_key}")
 
         try:
-            response = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-        except Exception as e:
-            print(f"❌ Error listing S3 objects: {str(e)}")
-            return {
-                'statusCode': 500,
-                'body': json.dumps({'error': 'Failed to access S3 bucket'})
-            }
-
-        if 'Contents' not in response:
-            return {
-                'statusCode': 404,
-                'body': json.dumps({'error': 'No matches found for this user. Search for a summoner first!'})
-            }
+            matches = load_consolidated_matches(s3, bucket_name, consolidated_key)
+        except s3.exceptions.NoSuchKey:
+            matches = None
+
+        if matches is None:
+            # Fall back to per-match files for users who haven't searched since matches.ndjson existed
+            try:
+                matches = load_match_objects(s3, bucket_name, puuid)
+            except Exception as e:
+                print(f"❌ Error loading match files: {str(e)}")
+                return {
+                    'statusCode': 500,
+                    'body': json.dumps({'error': 'Failed to access S3 bucket'})
+                }
+
+            if not matches:
+                return {
+                    'statusCode': 404,
+                    'body': json.dumps({'error': 'No matches found for this user. Search for a summoner first!'})
+                }
 
         # Collect match stats
         match_stats = []
 
-        for obj in response['Contents']:
-            key = obj['Key']
-            if not key.endswith('.json'):
-                continue
-
-            print(f"📊 Processing {key}")
-
-            # Read match data
-            match_obj = s3.get_object(Bucket=bucket_name, Key=key)
-            match_json = json.loads(match_obj['Body'].read().decode('utf-8'))
-
-            # Find the player's stats
-            player_stats = None
-            for participant in match_json['info']['participants']:
-                if participant['puuid'] == puuid:
-                    player_stats = participant
-                    break
+        for match_json in matches:
+            row = build_stats_row(match_json, puuid)
 
-            if not player_stats:
-                print(f"⚠️  Player not found in match {key}")
+            if row is None:
+                print(f"⚠️  Player not found in match {match_json['metadata']['matchId']}")
                 continue
 
-            # Extract clean stats
-            stats = {
-                'matchId': match_json['metadata']['matchId'],
-                'gameCreation': match_json['info']['gameCreation'],
-                'gameDuration': match_json['info']['gameDuration'],
-                'gameMode': match_json['info']['gameMode'],
-                'queueId': match_json['info']['queueId'],
-                'championName': player_stats['championName'],
-                'championId': player_stats['championId'],
-                'position': player_stats.get('teamPosition', 'UNKNOWN'),
-                'kills': player_stats['kills'],
-                'deaths': player_stats['deaths'],
-                'assists': player_stats['assists'],
-                'kdaRatio': round((player_stats['kills'] + player_stats['assists']) / max(player_stats['deaths'], 1), 2),
-                'cs': player_stats['totalMinionsKilled'] + player_stats['neutralMinionsKilled'],
-                'goldEarned': player_stats['goldEarned'],
-                'damageDealt': player_stats['totalDamageDealtToChampions'],
-                'damageTaken': player_stats['totalDamageTaken'],
-                'visionScore': player_stats['visionScore'],
-                'win': player_stats['win'],
-                'firstBlood': player_stats.get('firstBloodKill', False),
-                'doubleKills': player_stats['doubleKills'],
-                'tripleKills': player_stats['tripleKills'],
-                'quadraKills': player_stats['quadraKills'],
-                'pentaKills': player_stats['pentaKills'],
-            }
-
-            match_stats.append(stats)
+            match_stats.append(row)
 
         if not match_stats:
             return {
@@ -105,35 +81,20 @@ def lambda_handler(event, context):
                 'body': json.dumps({'error': 'No valid match data found'})
             }
 
-        # Create CSV
-        csv_buffer = StringIO()
-        fieldnames = match_stats[0].keys()
-        writer = csv.DictWriter(csv_buffer, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(match_stats)
-
-        # Save to S3
+        # Stream CSV to S3
         output_key = f"users/{puuid}/processed/match_stats.csv"
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=output_key,
-            Body=csv_buffer.getvalue(),
-            ContentType='text/csv'
-        )
+        upload_csv(s3, bucket_name, output_key, STATS_FIELDS, match_stats)
 
         print(f"✅ Processed {len(match_stats)} matches")
         print(f"📁 Saved to s3://{bucket_name}/{output_key}")
 
         # Return processed stats
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'matchesProcessed': len(match_stats),
-                'stats': match_stats,
-                's3Location': f"s3://{bucket_name}/{output_key}",
-                'message': f'Successfully processed {len(match_stats)} matches'
-            })
-        }
+        return gzip_json_response(event, {
+            'matchesProcessed': len(match_stats),
+            'stats': [dict(zip(STATS_FIELDS, row)) for row in match_stats],
+            's3Location': f"s3://{bucket_name}/{output_key}",
+            'message': f'Successfully processed {len(match_stats)} matches'
+        })
 
     except Exception as e:
         print(f"❌ Error: {str(e)}")
@@ -143,3 +104,46 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'body': json.dumps({'error': 'Internal server error', 'detail': str(e)})
         }
+
+def load_consolidated_matches(s3, bucket_name, key):
+    """Stream the per-user NDJSON match log from S3, one match per line"""
+    cached = match_cache.get(key)
+
+    try:
+        if cached:
+            # A 304 means the log hasn't changed since we last parsed it
+            match_obj = s3.get_object(Bucket=bucket_name, Key=key, IfNoneMatch=cached[0])
+        else:
+            match_obj = s3.get_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if cached and e.response['Error']['Code'] == '304':
+            print(f"📦 {key} unchanged, reusing {len(cached[1])} cached matches")
+            return cached[1]
+        raise
+
+    matches = [orjson.loads(line) for line in iter_body_lines(match_obj) if line.strip()]
+    cache_match_object(key, match_obj['ETag'], matches, len(matches))
+    print(f"📦 Loaded {len(matches)} matches from {key}")
+    return matches
+
+def gzip_json_response(event, payload):
+    """Build a 200 response, gzip-compressing the JSON body when the client accepts it"""
+    body = orjson.dumps(payload)
+    accept_encoding = (event.get('headers') or {}).get('accept-encoding', '')
+
+    if 'gzip' not in accept_encoding or len(body) < MIN_GZIP_RESPONSE_BYTES:
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': body.decode('utf-8')
+        }
+
+    return {
+        'statusCode': 200,
+        'isBase64Encoded': True,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip'
+        },
+        'body': base64.b64encode(gzip.compress(body, compresslevel=6)).decode('ascii')
+    }
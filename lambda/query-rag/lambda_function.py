@@ -1,9 +1,51 @@
 import json
 import boto3
+from botocore.exceptions import ClientError
 import os
+import re
 import csv
+import hashlib
+import time
 from io import StringIO
 
+# Claude 3 Haiku - Best price/performance
+MODEL_ID = os.environ.get('BEDROCK_MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0')
+
+# Bedrock only accepts cache_control on models that support prompt caching
+PROMPT_CACHING_MODELS = ('claude-3-5-haiku', 'claude-3-7-sonnet', 'claude-sonnet-4', 'claude-opus-4', 'claude-haiku-4-5')
+
+# Answers are cached per (PUUID, CSV version, question) and reused for an hour
+ANSWER_CACHE_PREFIX = 'rag-cache/'
+ANSWER_CACHE_TTL_SECONDS = 3600
+
+# Columns sent with every question, plus the extra columns relevant to question keywords.
+# Questions that match no keywords get the full CSV
+ALWAYS_INCLUDED_COLUMNS = {'matchId', 'championName', 'win'}
+QUESTION_COLUMN_GROUPS = (
+    (('champ', 'best', 'worst', 'pick'), {'championId', 'kills', 'deaths', 'assists', 'kdaRatio'}),
+    (('kda', 'kill', 'death', 'die', 'dying', 'assist', 'fight'),
+     {'kills', 'deaths', 'assists', 'kdaRatio', 'firstBlood'}),
+    (('multi', 'double', 'triple', 'quadra', 'penta'),
+     {'doubleKills', 'tripleKills', 'quadraKills', 'pentaKills'}),
+    (('gold', 'econom', 'farm', 'cs', 'minion', 'creep'), {'cs', 'goldEarned', 'gameDuration'}),
+    (('damage', 'dmg', 'tank', 'carry'), {'damageDealt', 'damageTaken'}),
+    (('vision', 'ward', 'map'), {'visionScore'}),
+    (('role', 'position', 'lane', 'top', 'jungle', 'mid', 'bot', 'adc', 'support'), {'position'}),
+    (('mode', 'queue', 'ranked', 'aram', 'normal'), {'gameMode', 'queueId'}),
+    (('recent', 'trend', 'streak', 'time', 'long', 'short', 'duration', 'when', 'improv'),
+     {'gameCreation', 'gameDuration'}),
+)
+
+# Keywords are matched against the start of each word in the question. Short ones like
+# 'cs', 'top' or 'mode' only match as whole words or simple inflections, so 'tactics',
+# 'stop' and 'model' don't pull in unrelated columns
+MIN_PREFIX_KEYWORD_LENGTH = 5
+KEYWORD_SUFFIXES = ('', 's', 'es', 'd', 'ed', 'r', 'er', 'ers', 'est', 'ing', 'y')
+
+# Created once per container so warm invocations reuse connections and credentials
+s3 = boto3.client('s3')
+bedrock = boto3.client('bedrock-runtime', region_name='us-east-1')
+
 def lambda_handler(event, context):
     """
     Query match data using Amazon Bedrock (RAG approach)
@@ -27,21 +69,15 @@ def lambda_handler(event, context):
         print(f"🔍 Question: {question}")
         print(f"👤 PUUID: {puuid[:20]}...")
 
-        # Initialize clients
-        s3 = boto3.client('s3')
-        bedrock = boto3.client('bedrock-runtime', region_name='us-east-1')
-
         # Check if processed data exists
         csv_key = f"users/{puuid}/processed/match_stats.csv"
 
         try:
-            # Read the processed CSV
-            csv_obj = s3.get_object(Bucket=bucket_name, Key=csv_key)
-            csv_content = csv_obj['Body'].read().decode('utf-8')
-
-            print(f"📊 Found processed data at {csv_key}")
-
-        except s3.exceptions.NoSuchKey:
+            # The CSV's ETag ties cached answers to this exact version of the data
+            csv_etag = s3.head_object(Bucket=bucket_name, Key=csv_key)['ETag']
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
             return {
                 'statusCode': 404,
                 'body': json.dumps({
@@ -50,18 +86,51 @@ def lambda_handler(event, context):
                 })
             }
 
-        # Build the prompt for Claude
-        prompt = f"""You are a League of Legends gameplay analyst. You have access to a player's match history data in CSV format.
+        # Repeated questions skip Bedrock entirely
+        cache_key = answer_cache_key(puuid, csv_etag, question)
+        cached_answer = get_cached_answer(s3, bucket_name, cache_key)
 
-Here is the player's match data:
+        if cached_answer is not None:
+            print(f"⚡ Answer cache hit: {cache_key}")
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'question': question,
+                    'answer': cached_answer,
+                    'dataSource': csv_key,
+                    'cached': True
+                })
+            }
+
+        # Read the processed CSV
+        csv_obj = s3.get_object(Bucket=bucket_name, Key=csv_key)
+        csv_content = csv_obj['Body'].read().decode('utf-8')
+
+        # The CSV may have been rewritten since the HEAD, so cache the answer
+        # under the version that was actually read
+        if csv_obj['ETag'] != csv_etag:
+            cache_key = answer_cache_key(puuid, csv_obj['ETag'], question)
+
+        print(f"📊 Found processed data at {csv_key}")
+
+        # Only send the columns this question needs to keep the prompt small
+        csv_content = select_question_columns(csv_content, question)
+
+        # Build the prompt for Claude. The instructions and CSV are identical for every
+        # question about this player, so they go first where they can be cached
+        data_prompt = f"""You are a League of Legends gameplay analyst. You have access to a player's match history data in CSV format.
 
-{csv_content}
+Please analyze the data and provide a helpful, insightful answer to the player's question. Be specific and reference actual statistics from the data. Keep your response concise but informative (2-3 paragraphs max).
 
-The player is asking: {question}
+If the question cannot be answered with the available data, explain what additional information would be needed.
 
-Please analyze the data and provide a helpful, insightful answer. Be specific and reference actual statistics from the data. Keep your response concise but informative (2-3 paragraphs max).
+Here is the player's match data:
+
+{csv_content}"""
 
-If the question cannot be answered with the available data, explain what additional information would be needed."""
+        data_block = {"type": "text", "text": data_prompt}
+        if any(model in MODEL_ID for model in PROMPT_CACHING_MODELS):
+            data_block["cache_control"] = {"type": "ephemeral"}
 
         # Call Bedrock Claude
         request_body = {
@@ -70,7 +139,10 @@ If the question cannot be answered with the available data, explain what additio
             "messages": [
                 {
                     "role": "user",
-                    "content": prompt
+                    "content": [
+                        data_block,
+                        {"type": "text", "text": f"The player is asking: {question}"}
+                    ]
                 }
             ]
         }
@@ -78,7 +150,7 @@ If the question cannot be answered with the available data, explain what additio
         print("🤖 Calling Bedrock Claude...")
 
         response = bedrock.invoke_model(
-            modelId='anthropic.claude-3-haiku-20240307-v1:0',  # Claude 3 Haiku - Best price/performance
+            modelId=MODEL_ID,
             body=json.dumps(request_body)
         )
 
@@ -88,6 +160,8 @@ If the question cannot be answered with the available data, explain what additio
 
         print(f"✅ Got answer from Claude ({len(answer)} chars)")
 
+        put_cached_answer(s3, bucket_name, cache_key, question, answer)
+
         return {
             'statusCode': 200,
             'body': json.dumps({
@@ -113,3 +187,70 @@ If the question cannot be answered with the available data, explain what additio
             'statusCode': 500,
             'body': json.dumps({'error': 'Internal server error', 'detail': error_msg})
         }
+
+def select_question_columns(csv_content, question):
+    """Reduce the CSV to the columns relevant to the question, keeping the original column order"""
+    words = re.findall(r'[a-z]+', question.lower())
+    columns = set(ALWAYS_INCLUDED_COLUMNS)
+    for keywords, group in QUESTION_COLUMN_GROUPS:
+        if any(keyword_matches(keyword, words) for keyword in keywords):
+            columns |= group
+
+    # No keyword matched, so the question is too general to trim safely
+    if columns == ALWAYS_INCLUDED_COLUMNS:
+        return csv_content
+
+    rows = csv.reader(StringIO(csv_content))
+    header = next(rows, None)
+    if header is None:
+        return csv_content
+
+    indexes = [i for i, name in enumerate(header) if name in columns]
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow([header[i] for i in indexes])
+    writer.writerows([row[i] for i in indexes] for row in rows)
+
+    print(f"✂️  Sending {len(indexes)}/{len(header)} columns to Bedrock")
+    return output.getvalue()
+
+def keyword_matches(keyword, words):
+    """Check whether any question word starts with the keyword, or is a short keyword plus an inflection"""
+    if len(keyword) >= MIN_PREFIX_KEYWORD_LENGTH:
+        return any(word.startswith(keyword) for word in words)
+    return any(word.startswith(keyword) and word[len(keyword):] in KEYWORD_SUFFIXES for word in words)
+
+def answer_cache_key(puuid, csv_etag, question):
+    """Build the S3 key for a cached answer, ignoring case and whitespace in the question"""
+    normalized_question = ' '.join(question.lower().split())
+    digest = hashlib.sha256(f"{puuid}|{csv_etag}|{normalized_question}".encode('utf-8')).hexdigest()
+    return f"{ANSWER_CACHE_PREFIX}{puuid}/{digest}.json"
+
+def get_cached_answer(s3, bucket_name, cache_key):
+    """Return a cached answer if one exists and hasn't expired, otherwise None"""
+    try:
+        cache_obj = s3.get_object(Bucket=bucket_name, Key=cache_key)
+        cached = json.loads(cache_obj['Body'].read())
+
+        # A malformed cache entry is treated as a miss rather than failing the request
+        if time.time() - cached['cachedAt'] > ANSWER_CACHE_TTL_SECONDS:
+            return None
+
+        return cached['answer']
+    except s3.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        print(f"⚠️  Failed to read answer cache: {str(e)}")
+        return None
+
+def put_cached_answer(s3, bucket_name, cache_key, question, answer):
+    """Store an answer in the cache; failures are logged but never fail the request"""
+    try:
+        s3.put_object(
+            Bucket=bucket_name,
+            Key=cache_key,
+            Body=json.dumps({'question': question, 'answer': answer, 'cachedAt': time.time()}),
+            ContentType='application/json'
+        )
+    except Exception as e:
+        print(f"⚠️  Failed to write answer cache: {str(e)}")
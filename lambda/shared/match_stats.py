@@ -0,0 +1,254 @@
+"""Match record and processed-stats CSV helpers shared by test-riot-api and process-matches"""
+import csv
+import gzip
+import ijson
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, TextIOWrapper
+
+# Match downloads are network-bound, so overlap them across a pool of threads
+MAX_DOWNLOAD_WORKERS = 16
+
+# Game-level fields kept from each match alongside the player's participant entry
+MATCH_INFO_FIELDS = ('gameCreation', 'gameDuration', 'gameMode', 'queueId')
+
+# Column order of the processed CSV; each stats row is a tuple in this order
+STATS_FIELDS = (
+    'matchId', 'gameCreation', 'gameDuration', 'gameMode', 'queueId',
+    'championName', 'championId', 'position',
+    'kills', 'deaths', 'assists', 'kdaRatio', 'cs',
+    'goldEarned', 'damageDealt', 'damageTaken', 'visionScore',
+    'win', 'firstBlood', 'doubleKills', 'tripleKills', 'quadraKills', 'pentaKills',
+)
+
+# S3 multipart uploads require every part except the last to be at least 5 MiB
+MULTIPART_CHUNK_SIZE = 5 * 1024 * 1024
+
+# Parsed match objects from earlier warm invocations: S3 key -> (ETag, parsed value, match count).
+# Unchanged objects are reused instead of downloaded and parsed again. The cap counts matches
+# rather than entries, since one consolidated log entry holds a player's whole history
+match_cache = {}
+MATCH_CACHE_MAX_MATCHES = 2000
+_match_cache_lock = threading.Lock()
+_cached_match_count = 0
+
+def load_match_objects(s3, bucket_name, puuid, skip_match_ids=(), use_cache=True):
+    """Load every per-match file under users/{puuid}/matches/ as a match record,
+    except those whose match ID is in skip_match_ids"""
+    prefix = f"users/{puuid}/matches/"
+
+    print(f"🔍 Looking for matches at s3://{bucket_name}/{prefix}")
+
+    # Paginate so users with more than 1000 matches aren't truncated, and
+    # start downloads while later pages are still being listed
+    paginator = s3.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=bucket_name, Prefix=prefix, PaginationConfig={'PageSize': 1000})
+
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        futures = [
+            executor.submit(fetch_match, s3, bucket_name, obj['Key'], obj['ETag'], puuid, use_cache)
+            for page in pages
+            for obj in page.get('Contents', [])
+            if obj['Key'].endswith('.json')
+            and obj['Key'][len(prefix):-len('.json')] not in skip_match_ids
+        ]
+        return [future.result() for future in futures]
+
+def fetch_match(s3, bucket_name, key, etag, puuid, use_cache=True):
+    """Stream a match JSON from S3, keeping only the game info and this player's entry"""
+    # The listing already gave us the ETag, so an unchanged match needs no request at all
+    cached = match_cache.get(key) if use_cache else None
+    if cached and cached[0] == etag:
+        return cached[1]
+
+    print(f"📊 Processing {key}")
+    match_obj = s3.get_object(Bucket=bucket_name, Key=key)
+
+    match_json = {'metadata': {}, 'info': {'participants': []}}
+    info = match_json['info']
+    builder = None
+
+    # metadata.participants lists PUUIDs in the same order as info.participants and comes
+    # first in the document, so it tells us which participant slot to build
+    metadata_count = 0
+    participant_count = 0
+    player_index = None
+
+    # Parse while downloading and stop as soon as everything we need has been seen,
+    # rather than decoding all ten participants and the team objectives
+    for prefix, event, value in ijson.parse(open_body(match_obj), use_float=True):
+        if builder is not None:
+            if prefix == 'info.participants.item' and event == 'end_map':
+                if builder.value.get('puuid') == puuid:
+                    info['participants'].append(builder.value)
+                builder = None
+            else:
+                builder.event(event, value)
+        elif prefix == 'info.participants.item' and event == 'start_map':
+            if not info['participants'] and player_index in (None, participant_count):
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            participant_count += 1
+        elif prefix == 'metadata.participants.item':
+            if value == puuid:
+                player_index = metadata_count
+            metadata_count += 1
+        elif prefix == 'metadata.participants' and event == 'end_array' and player_index is None:
+            # The player isn't in this match, so there's nothing else to read
+            break
+        elif prefix == 'metadata.matchId':
+            match_json['metadata']['matchId'] = value
+        elif prefix.startswith('info.') and prefix[5:] in MATCH_INFO_FIELDS:
+            info[prefix[5:]] = value
+
+        if (info['participants'] and 'matchId' in match_json['metadata']
+                and all(field in info for field in MATCH_INFO_FIELDS)):
+            break
+
+    # Read the unparsed tail before closing: urllib3 only returns a fully read response's
+    # connection to the pool, and closing one part-way through drops the connection
+    match_obj['Body'].read()
+    match_obj['Body'].close()
+    if use_cache:
+        cache_match_object(key, match_obj['ETag'], match_json)
+    return match_json
+
+def cache_match_object(key, etag, value, match_count=1):
+    """Remember a parsed S3 object by ETag, starting over once the cache would hold too many matches"""
+    global _cached_match_count
+    with _match_cache_lock:
+        previous = match_cache.pop(key, None)
+        if previous:
+            _cached_match_count -= previous[2]
+
+        if _cached_match_count + match_count > MATCH_CACHE_MAX_MATCHES:
+            match_cache.clear()
+            _cached_match_count = 0
+
+        match_cache[key] = (etag, value, match_count)
+        _cached_match_count += match_count
+
+def slim_match_record(match_data, player_data):
+    """Reduce a full match to the record kept in the match log: its game info and the player's entry"""
+    info = match_data['info']
+    return {
+        'metadata': {'matchId': match_data['metadata']['matchId']},
+        'info': {
+            **{field: info[field] for field in MATCH_INFO_FIELDS},
+            'participants': [player_data] if player_data else []
+        }
+    }
+
+def build_stats_row(match_json, puuid):
+    """Flatten a match record into a stats row in STATS_FIELDS order, or None if the player is missing"""
+    info = match_json['info']
+    player_stats = next((p for p in info['participants'] if p['puuid'] == puuid), None)
+
+    if not player_stats:
+        return None
+
+    return (
+        match_json['metadata']['matchId'],
+        info['gameCreation'],
+        info['gameDuration'],
+        info['gameMode'],
+        info['queueId'],
+        player_stats['championName'],
+        player_stats['championId'],
+        player_stats.get('teamPosition', 'UNKNOWN'),
+        player_stats['kills'],
+        player_stats['deaths'],
+        player_stats['assists'],
+        round((player_stats['kills'] + player_stats['assists']) / max(player_stats['deaths'], 1), 2),
+        player_stats['totalMinionsKilled'] + player_stats['neutralMinionsKilled'],
+        player_stats['goldEarned'],
+        player_stats['totalDamageDealtToChampions'],
+        player_stats['totalDamageTaken'],
+        player_stats['visionScore'],
+        player_stats['win'],
+        player_stats.get('firstBloodKill', False),
+        player_stats['doubleKills'],
+        player_stats['tripleKills'],
+        player_stats['quadraKills'],
+        player_stats['pentaKills'],
+    )
+
+def open_body(s3_object):
+    """Return a readable stream of an S3 object's body, decompressing gzip-encoded objects"""
+    if s3_object.get('ContentEncoding') == 'gzip':
+        return gzip.GzipFile(fileobj=s3_object['Body'])
+    return s3_object['Body']
+
+def iter_body_lines(s3_object):
+    """Yield the lines of an S3 object's body, decompressing gzip-encoded objects"""
+    if s3_object.get('ContentEncoding') == 'gzip':
+        yield from open_body(s3_object)
+    else:
+        yield from s3_object['Body'].iter_lines()
+
+def upload_csv(s3, bucket_name, key, fieldnames, rows):
+    """Write CSV rows to S3, flushing multipart parts as each 5 MiB chunk fills"""
+    # Rows are encoded straight into a bytes buffer that is handed to boto3 as a file,
+    # so there's no intermediate str or getvalue() copy of the CSV
+    buffer = BytesIO()
+    text = TextIOWrapper(buffer, encoding='utf-8', newline='', write_through=True)
+    writer = csv.writer(text)
+    writer.writerow(fieldnames)
+
+    upload_id = None
+    parts = []
+
+    try:
+        for row in rows:
+            writer.writerow(row)
+
+            if buffer.tell() >= MULTIPART_CHUNK_SIZE:
+                if upload_id is None:
+                    upload_id = s3.create_multipart_upload(
+                        Bucket=bucket_name,
+                        Key=key,
+                        ContentType='text/csv'
+                    )['UploadId']
+                parts.append(upload_part(s3, bucket_name, key, upload_id, len(parts) + 1, buffer))
+
+        if upload_id is None:
+            # Everything fit in one chunk, so a single PUT is cheaper than a multipart upload
+            buffer.seek(0)
+            s3.put_object(
+                Bucket=bucket_name,
+                Key=key,
+                Body=buffer,
+                ContentType='text/csv'
+            )
+            return
+
+        if buffer.tell():
+            parts.append(upload_part(s3, bucket_name, key, upload_id, len(parts) + 1, buffer))
+
+        s3.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts}
+        )
+    except Exception:
+        if upload_id is not None:
+            s3.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+        raise
+    finally:
+        # Stop the wrapper from closing the buffer when it's garbage collected
+        text.detach()
+
+def upload_part(s3, bucket_name, key, upload_id, part_number, buffer):
+    """Upload the buffered chunk as one part, empty the buffer and return the part entry"""
+    buffer.seek(0)
+    response = s3.upload_part(
+        Bucket=bucket_name,
+        Key=key,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=buffer
+    )
+    buffer.seek(0)
+    buffer.truncate()
+    return {'PartNumber': part_number, 'ETag': response['ETag']}
@@ -1,9 +1,104 @@
 import json
+import orjson
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
 import urllib3
+from urllib3.exceptions import MaxRetryError, ResponseError
 from urllib.parse import quote
 from datetime import datetime
 import os
+import time
+import gzip
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from match_stats import (
+    STATS_FIELDS, build_stats_row, iter_body_lines, load_match_objects, slim_match_record, upload_csv
+)
+
+# Riot development keys allow 20 requests per second and 100 per two minutes. Request
+# starts are spaced out across all threads to stay just under the per-second limit
+RIOT_REQUESTS_PER_SECOND = 18
+
+# Match fetches and S3 writes are network-bound, so overlap them across threads.
+# The pacing above, not the worker count, is what keeps Riot calls under the limit
+MAX_MATCH_WORKERS = 16
+
+# Retry-After waits up to this long are slept through before retrying. Once the two-minute
+# limit is hit Riot asks for waits far past the 30s Lambda timeout, so those 429s are
+# returned straight away instead of being retried
+MAX_RETRY_AFTER_SECONDS = 3
+
+class CappedRetry(urllib3.Retry):
+    """Retry policy that gives up when Retry-After exceeds MAX_RETRY_AFTER_SECONDS
+    and paces each retry like any other Riot request"""
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None:
+            retry_after = self.get_retry_after(response)
+            if retry_after is not None and retry_after > MAX_RETRY_AFTER_SECONDS:
+                raise MaxRetryError(_pool, url, ResponseError(f"Retry-After of {retry_after}s is too long to wait"))
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        wait_for_riot_slot()
+
+# Retry rate-limited (429) and transient server errors, honouring Riot's Retry-After header.
+# The final response is returned rather than raised so the status checks below still apply
+RIOT_RETRY = CappedRetry(
+    total=3,
+    backoff_factor=0.2,
+    status_forcelist=(429, 500, 502, 503, 504),
+    respect_retry_after_header=True,
+    raise_on_status=False
+)
+
+# Platform region -> (Account API routing for Riot ID lookup, Match API routing for match history)
+REGION_ROUTING = {
+    'na1': ('americas', 'americas'),
+    'br1': ('americas', 'americas'),
+    'la1': ('americas', 'americas'),
+    'la2': ('americas', 'americas'),
+    'oc1': ('americas', 'sea'),  # OC1 uses americas for account API but sea for match API
+    'euw1': ('europe', 'europe'),
+    'eun1': ('europe', 'europe'),
+    'tr1': ('europe', 'europe'),
+    'ru': ('europe', 'europe'),
+    'kr': ('asia', 'asia'),
+    'jp1': ('asia', 'asia'),
+    'ph2': ('sea', 'sea'),
+    'sg2': ('sea', 'sea'),
+    'th2': ('sea', 'sea'),
+    'tw2': ('sea', 'sea'),
+    'vn2': ('sea', 'sea')
+}
+DEFAULT_ROUTING = ('americas', 'americas')
+
+# Full Riot match JSON is only needed for debugging now that stats come from the match log
+STORE_RAW_MATCHES = os.environ.get('STORE_RAW_MATCHES', 'true').lower() == 'true'
+
+# Raw match uploads are small, so they go up as single PUTs on the transfer manager's threads
+UPLOAD_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=10, use_threads=True)
+
+# Times a match log update is retried when another search rewrote the log mid-merge
+MATCH_LOG_WRITE_ATTEMPTS = 3
+
+# How long a Parameter Store lookup of the API key is reused across warm invocations
+API_KEY_CACHE_SECONDS = 300
+
+# Clients are created once per container so warm invocations reuse connections and credentials
+ssm = boto3.client('ssm', region_name='us-east-1')
+s3 = boto3.client('s3', config=Config(max_pool_connections=MAX_MATCH_WORKERS))
+http = urllib3.PoolManager(maxsize=MAX_MATCH_WORKERS, retries=RIOT_RETRY)
+
+_api_key_cache = {}
+
+# Earliest time the next Riot request may start, shared by every fetch thread
+_riot_pace_lock = threading.Lock()
+_riot_next_request_at = 0.0
 
 def lambda_handler(event, context):
     """
@@ -37,14 +132,8 @@ def lambda_handler(event, context):
             }
         
         # Get API key from Parameter Store
-        ssm = boto3.client('ssm', region_name='us-east-1')
         try:
-            parameter = ssm.get_parameter(
-                Name=api_key_param,
-                WithDecryption=True
-            )
-            api_key = parameter['Parameter']['Value']
-            print(f"✅ Retrieved API key from Parameter Store")
+            api_key = get_api_key(api_key_param)
         except Exception as e:
             print(f"❌ Failed to get API key: {str(e)}")
             return {
@@ -56,9 +145,6 @@ def lambda_handler(event, context):
         print(f"🎮 Looking up: {summoner_name} in region {region}")
         print(f"📊 Fetching {match_count} matches")
         
-        # Initialize HTTP client and S3
-        http = urllib3.PoolManager()
-        s3 = boto3.client('s3')
         headers = {'X-Riot-Token': api_key}
 
         # Step 1: Get account PUUID using Riot ID
@@ -67,14 +153,13 @@ def lambda_handler(event, context):
         tag_line = quote(tag_line)
 
         # Get routing values for this region
-        account_routing = get_account_routing(region)
-        match_routing = get_match_routing(region)
+        account_routing, match_routing = get_routing(region)
 
         account_url = f"https://{account_routing}.api.riotgames.com/riot/account/v1/accounts/by-riot-id/{game_name}/{tag_line}"
         
         print(f"🔗 Account API URL: {account_url}")
         
-        account_response = http.request('GET', account_url, headers=headers)
+        account_response = riot_get(http, account_url, headers)
         
         print(f"📊 Account API Response Status: {account_response.status}")
         
@@ -103,7 +188,7 @@ def lambda_handler(event, context):
                 })
             }
         
-        account_data = json.loads(account_response.data.decode('utf-8'))
+        account_data = orjson.loads(account_response.data)
         puuid = account_data['puuid']
         
         print(f"✅ Got PUUID: {puuid[:20]}...")
@@ -113,7 +198,7 @@ def lambda_handler(event, context):
         
         print(f"🔗 Summoner API URL: {summoner_url}")
         
-        summoner_response = http.request('GET', summoner_url, headers=headers)
+        summoner_response = riot_get(http, summoner_url, headers)
         
         print(f"📊 Summoner API Response Status: {summoner_response.status}")
         
@@ -128,7 +213,7 @@ def lambda_handler(event, context):
                 })
             }
         
-        summoner_data = json.loads(summoner_response.data.decode('utf-8'))
+        summoner_data = orjson.loads(summoner_response.data)
         full_summoner_name = f"{account_data['gameName']}#{account_data['tagLine']}"
 
         print(f"✅ Got summoner level: {summoner_data['summonerLevel']}")
@@ -147,7 +232,7 @@ def lambda_handler(event, context):
         s3.put_object(
             Bucket=bucket_name,
             Key=profile_key,
-            Body=json.dumps(profile_data, indent=2),
+            Body=orjson.dumps(profile_data, option=orjson.OPT_INDENT_2),
             ContentType='application/json'
         )
         print(f"💾 Saved profile to S3: {profile_key}")
@@ -156,7 +241,7 @@ def lambda_handler(event, context):
         match_list_url = f"https://{match_routing}.api.riotgames.com/lol/match/v5/matches/by-puuid/{puuid}/ids?start=0&count={match_count}"
 
         print(f"🔗 Match list URL: {match_list_url}")
-        match_list_response = http.request('GET', match_list_url, headers=headers)
+        match_list_response = riot_get(http, match_list_url, headers)
 
         if match_list_response.status != 200:
             print(f"⚠️  Failed to fetch match list: {match_list_response.status}")
@@ -167,7 +252,7 @@ def lambda_handler(event, context):
                 })
             }
 
-        match_ids = json.loads(match_list_response.data.decode('utf-8'))
+        match_ids = orjson.loads(match_list_response.data)
 
         if not match_ids:
             return {
@@ -180,28 +265,35 @@ def lambda_handler(event, context):
         # Step 4: Fetch and process each match
         processed_matches = []
 
-        for i, match_id in enumerate(match_ids):
-            print(f"🎮 Processing match {i+1}/{len(match_ids)}: {match_id}")
-
-            # Get full match data
-            match_url = f"https://{match_routing}.api.riotgames.com/lol/match/v5/matches/{match_id}"
-            match_response = http.request('GET', match_url, headers=headers)
-
-            if match_response.status != 200:
-                print(f"⚠️  Failed to fetch match {match_id}: {match_response.status}")
-                continue
-
-            match_data = json.loads(match_response.data.decode('utf-8'))
-
-            # Save full match data to S3
-            match_key = f"users/{puuid}/matches/{match_id}.json"
-            s3.put_object(
-                Bucket=bucket_name,
-                Key=match_key,
-                Body=json.dumps(match_data, indent=2),
-                ContentType='application/json'
-            )
-
+        fetched_matches = []
+        upload_futures = []
+
+        # Each raw match is queued for upload as soon as it arrives, so S3 writes
+        # run behind the remaining Riot fetches instead of blocking them
+        with ThreadPoolExecutor(max_workers=MAX_MATCH_WORKERS) as executor, \
+                create_transfer_manager(s3, UPLOAD_CONFIG) as transfer_manager:
+            for match_id, match_data, match_body in executor.map(
+                lambda match_id: fetch_match(http, headers, match_routing, match_id),
+                match_ids
+            ):
+                if match_data is None:
+                    continue
+
+                match_key = f"users/{puuid}/matches/{match_id}.json"
+                if STORE_RAW_MATCHES:
+                    upload_futures.append(transfer_manager.upload(
+                        BytesIO(match_body),
+                        bucket_name,
+                        match_key,
+                        extra_args={'ContentType': 'application/json', 'ContentEncoding': 'gzip'}
+                    ))
+                fetched_matches.append((match_id, match_key, match_data))
+
+            # Raise if any upload failed
+            for future in upload_futures:
+                future.result()
+
+        for match_id, match_key, match_data in fetched_matches:
             # Extract player stats
             player_stats = extract_player_stats(match_data, puuid)
             if player_stats:
@@ -218,17 +310,35 @@ def lambda_handler(event, context):
                     'gameMode': player_stats.get('gameMode'),
                     'gameDuration': player_stats.get('gameDuration'),
                     'cs': player_stats.get('totalMinionsKilled', 0) + player_stats.get('neutralMinionsKilled', 0),
-                    's3Key': match_key
+                    's3Key': match_key if STORE_RAW_MATCHES else None
                 })
                 print(f"  ✅ {player_stats.get('championName')} - {'Win' if player_stats.get('win') else 'Loss'}")
 
+        # Append this batch to the consolidated per-user match log
+        match_log_key, match_records = append_match_log(
+            s3, bucket_name, puuid,
+            [
+                slim_match_record(match_data, find_participant(match_data, puuid))
+                for _, _, match_data in fetched_matches
+            ]
+        )
+        print(f"💾 Updated match log in S3: {match_log_key}")
+
+        # Write the processed stats CSV from the in-memory log, the same output as
+        # process-matches but without reading every match back out of S3
+        stats_rows = [row for row in (build_stats_row(record, puuid) for record in match_records) if row]
+        stats_key = f"users/{puuid}/processed/match_stats.csv"
+        upload_csv(s3, bucket_name, stats_key, STATS_FIELDS, stats_rows)
+        print(f"📁 Saved {len(stats_rows)} processed matches to S3: {stats_key}")
+
         # Format response
         response_data = {
             'summoner': {
                 'name': full_summoner_name,
                 'level': summoner_data['summonerLevel'],
                 'puuid': puuid,
-                'profileS3Key': profile_key
+                'profileS3Key': profile_key,
+                'statsS3Key': stats_key
             },
             'matchesProcessed': len(processed_matches),
             'matches': processed_matches,
@@ -251,17 +361,119 @@ def lambda_handler(event, context):
             'body': json.dumps({'error': 'Internal server error', 'detail': str(e)})
         }
 
+def get_api_key(api_key_param):
+    """Get the Riot API key from Parameter Store, reusing it for a few minutes between calls"""
+    cached = _api_key_cache.get(api_key_param)
+    if cached and time.time() - cached[1] < API_KEY_CACHE_SECONDS:
+        return cached[0]
+
+    parameter = ssm.get_parameter(
+        Name=api_key_param,
+        WithDecryption=True
+    )
+    api_key = parameter['Parameter']['Value']
+    _api_key_cache[api_key_param] = (api_key, time.time())
+    print(f"✅ Retrieved API key from Parameter Store")
+    return api_key
+
+def wait_for_riot_slot():
+    """Block until the next Riot request may start, spacing starts RIOT_REQUESTS_PER_SECOND apart"""
+    global _riot_next_request_at
+    with _riot_pace_lock:
+        now = time.monotonic()
+        start_at = max(now, _riot_next_request_at)
+        _riot_next_request_at = start_at + 1 / RIOT_REQUESTS_PER_SECOND
+    time.sleep(start_at - now)
+
+def riot_get(http, url, headers):
+    """GET a Riot API URL once a request slot is free"""
+    wait_for_riot_slot()
+    return http.request('GET', url, headers=headers)
+
+def fetch_match(http, headers, match_routing, match_id):
+    """Fetch full match data from the Riot API, returning it parsed and, if raw matches are stored, gzipped"""
+    print(f"🎮 Processing match {match_id}")
+
+    # Get full match data
+    match_url = f"https://{match_routing}.api.riotgames.com/lol/match/v5/matches/{match_id}"
+    match_response = riot_get(http, match_url, headers)
+
+    if match_response.status == 429:
+        print(f"⏳ Rate limited by Riot, skipping match {match_id} (Retry-After {match_response.headers.get('Retry-After')}s)")
+        return match_id, None, None
+
+    if match_response.status != 200:
+        print(f"⚠️  Failed to fetch match {match_id}: {match_response.status}")
+        return match_id, None, None
+
+    # Riot already sends minified JSON, so the raw bytes are compressed as-is for S3.
+    # Compressing here keeps the work on the fetch threads, and skips it when nothing is uploaded
+    match_body = gzip.compress(match_response.data) if STORE_RAW_MATCHES else None
+    return match_id, orjson.loads(match_response.data), match_body
+
+def append_match_log(s3, bucket_name, puuid, records):
+    """Merge match records into users/{puuid}/matches.ndjson (one JSON object per line)
+    and return the log's key along with every record now in it"""
+    match_log_key = f"users/{puuid}/matches.ndjson"
+    batch_match_ids = {record['metadata']['matchId'] for record in records}
+
+    # S3 has no append, so read the existing log, merge by match ID and re-put. The put is
+    # conditional on the log being unchanged, so overlapping searches for the same player
+    # retry the merge instead of overwriting each other's matches
+    for attempt in range(1, MATCH_LOG_WRITE_ATTEMPTS + 1):
+        merged = {}
+        try:
+            existing = s3.get_object(Bucket=bucket_name, Key=match_log_key)
+            for line in iter_body_lines(existing):
+                if line.strip():
+                    record = orjson.loads(line)
+                    merged[record['metadata']['matchId']] = record
+            write_condition = {'IfMatch': existing['ETag']}
+        except s3.exceptions.NoSuchKey:
+            # First log for this user: carry over matches already stored as per-match files,
+            # since process-matches stops reading those once the log exists. This batch's
+            # matches were just uploaded but are already in hand, so they aren't re-read. This
+            # function never reads the match cache, so the seed doesn't fill it either
+            seeded = load_match_objects(s3, bucket_name, puuid, skip_match_ids=batch_match_ids, use_cache=False)
+            for record in seeded:
+                if record['info']['participants']:
+                    merged[record['metadata']['matchId']] = record
+            write_condition = {'IfNoneMatch': '*'}
+
+        for record in records:
+            merged[record['metadata']['matchId']] = record
+
+        try:
+            s3.put_object(
+                Bucket=bucket_name,
+                Key=match_log_key,
+                Body=gzip.compress(b''.join(orjson.dumps(record) + b'\n' for record in merged.values())),
+                ContentType='application/x-ndjson',
+                ContentEncoding='gzip',
+                **write_condition
+            )
+        except ClientError as e:
+            if (e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict')
+                    or attempt == MATCH_LOG_WRITE_ATTEMPTS):
+                raise
+            print(f"🔁 Match log changed during merge, retrying (attempt {attempt + 1})")
+            continue
+
+        return match_log_key, list(merged.values())
+
+def find_participant(match_data, puuid):
+    """Look up a player's participant entry via the PUUID order in metadata.participants"""
+    try:
+        index = match_data['metadata']['participants'].index(puuid)
+    except ValueError:
+        return None
+    return match_data['info']['participants'][index]
+
 def extract_player_stats(match_data, puuid):
     """Extract relevant player statistics from match data"""
     try:
         # Find the participant data for our player
-        participants = match_data['info']['participants']
-        player_data = None
-
-        for participant in participants:
-            if participant['puuid'] == puuid:
-                player_data = participant
-                break
+        player_data = find_participant(match_data, puuid)
 
         if not player_data:
             return None
@@ -311,46 +523,6 @@ def extract_player_stats(match_data, puuid):
         print(f"❌ Error extracting player stats: {str(e)}")
         return None
 
-def get_account_routing(region):
-    """Map platform region to routing value for Account API (Riot ID lookup)"""
-    routing_map = {
-        'na1': 'americas',
-        'br1': 'americas',
-        'la1': 'americas',
-        'la2': 'americas',
-        'oc1': 'americas',  # OC1 uses americas for account API
-        'euw1': 'europe',
-        'eun1': 'europe',
-        'tr1': 'europe',
-        'ru': 'europe',
-        'kr': 'asia',
-        'jp1': 'asia',
-        'ph2': 'sea',
-        'sg2': 'sea',
-        'th2': 'sea',
-        'tw2': 'sea',
-        'vn2': 'sea'
-    }
-    return routing_map.get(region, 'americas')
-
-def get_match_routing(region):
-    """Map platform region to routing value for Match API (match history)"""
-    routing_map = {
-        'na1': 'americas',
-        'br1': 'americas',
-        'la1': 'americas',
-        'la2': 'americas',
-        'oc1': 'sea',  # OC1 uses sea for match API
-        'euw1': 'europe',
-        'eun1': 'europe',
-        'tr1': 'europe',
-        'ru': 'europe',
-        'kr': 'asia',
-        'jp1': 'asia',
-        'ph2': 'sea',
-        'sg2': 'sea',
-        'th2': 'sea',
-        'tw2': 'sea',
-        'vn2': 'sea'
-    }
-    return routing_map.get(region, 'americas')
\ No newline at end of file
+def get_routing(region):
+    """Map platform region to (Account API, Match API) routing values"""
+    return REGION_ROUTING.get(region, DEFAULT_ROUTING)
\ No newline at end of file